@@ -5,6 +5,14 @@ import math
 import multiprocessing
 import sklearn.neighbors
 import collections
+import tempfile
+import shutil
+import atexit
+import json
+import os
+import signal
+import errno
+import glob
 
 
 __NCPU__ = multiprocessing.cpu_count()
@@ -43,42 +51,21 @@ def WriteFitsTable(filename=None,colnames=[],types=[],*arg):
 
 	return tbhdu
 
-def GetMaskArray(filename=None,ra=[],dec=[],units='degrees'):
-
+def GetMaskHeader(filename=None):
 	"""
-	Given a a set of positons at the sky, returns an ordered array with the value of the mask at that position.
-	A recentering is performed to ensure the coordinates to be -180 deg < ra < 180 deg.
+	Reads the resolution and the ordering of a HEALPix mask from its header.
 
 	-Input:
 		filename (str): The path to the HEALPix mask.
-		ra (array): An array of floats containing the ra of each point of the sky.
-		dec (array): An array of floats containing the dec of each point of the sky.
-		units (str): Units of the input ra and dec. Degrees, arcmin or rad
-
 	-Output:
-		maskvalues (list): a list containing the value of the HEALPIx mask on each point. 
+		nside (int): The nside of the mask.
+		isnest (bool): True if the mask is on NESTED ordering, False if RING.
 	"""
 
-	if len(ra) == 0:
-		raise ValueError('No ra given.')
-	if len(dec) == 0:
-		raise ValueError('No dec given.')
-	if not len(ra) == len(dec):
-		raise Exception('The size of the ra and dec arrays is different.')
-	if not units in ['degrees','radians','arcmin']:
-		raise ValueError('No recognized angular units.')
-
-	if units == 'degrees':
-		ra  = map(lambda ra_ : ra_ *numpy.pi/180.,ra )
-		dec = map(lambda dec_: dec_*numpy.pi/180.,dec)
+	header   = fits.open(filename)[1].header
+	ordering = header['ordering']
+	nside    = int(header['nside'])
 
-	elif units == 'arcsec':
-		ra  = map(lambda ra_ : ra_ /60.,ra )
-		dec = map(lambda dec_: dec_/60.,dec)
-	
-	ordering = fits.open(filename)[1].header['ordering']
-	nside    = fits.open(filename)[1].header['nside']
-	
 	if ordering == 'NESTED':
 		isnest = True
 	elif ordering == 'RING':
@@ -86,25 +73,339 @@ def GetMaskArray(filename=None,ra=[],dec=[],units='degrees'):
 	else:
 		raise Exception('Wrong ordering value '+ordering)
 
-	mask = healpy.read_map(filename,nest=isnest)
+	return nside,isnest
+
+def GetPixelIndex(ra=[],dec=[],nside=None,nest=True,units='degrees'):
+	"""
+	Computes the HEALPix pixel index of a set of positions at the sky.
+
+	-Input:
+		ra (array): An array of floats containing the ra of each point of the sky.
+		dec (array): An array of floats containing the dec of each point of the sky.
+		nside (int): The nside of the pixelization.
+		nest (bool): If True the NESTED ordering is used, RING otherwise.
+		units (str): Units of the input ra and dec. Degrees, arcmin or rad
+	-Output:
+		pix (array): An array of integers containing the pixel of each point.
+	"""
+
+	ra  = numpy.asarray(ra ,dtype=numpy.float64)
+	dec = numpy.asarray(dec,dtype=numpy.float64)
+
+	if units == 'degrees':
+		ra  = numpy.radians(ra )
+		dec = numpy.radians(dec)
+	elif units == 'arcmin':
+		ra  = numpy.radians(ra /60.)
+		dec = numpy.radians(dec/60.)
+
+	return healpy.ang2pix( nside,numpy.pi/2.-dec,ra,nest=nest )
+
+def ChangePixelResolution(pix=[],nside_in=None,nside_out=None):
+	"""
+	Degrades a NESTED pixel index to a coarser resolution by bit-shifting.
+	On NESTED ordering the parent of a pixel at nside_out <= nside_in is pix >> 2*log2(nside_in/nside_out),
+	so no ang2pix is needed to move a pixel index down in resolution.
+
+	-Input:
+		pix (array): An array of integers containing NESTED pixel indices at nside_in.
+		nside_in (int): The nside of the input indices.
+		nside_out (int): The nside of the output indices.
+	-Output:
+		pix (array): An array of integers containing NESTED pixel indices at nside_out.
+	"""
+
+	if nside_out == nside_in:
+		return pix
+	if nside_out > nside_in:
+		raise ValueError('Can not upgrade a pixel index from nside '+str(nside_in)+' to '+str(nside_out)+'.')
+
+	shift = 2*int(round(math.log(float(nside_in)/nside_out,2)))
+	return numpy.right_shift(pix,shift)
+
+_SHARED_OWNED = {}
+
+def _CleanSharedCatalogs():
+	for name_,pid_ in list(_SHARED_OWNED.items()):
+		if pid_ == os.getpid():
+			shutil.rmtree(name_,ignore_errors=True)
+			del _SHARED_OWNED[name_]
+
+atexit.register(_CleanSharedCatalogs)
+
+_SIGTERM_HANDLER = []
+
+def _OnSigterm(signum,frame):
+	_CleanSharedCatalogs()
+	previous = _SIGTERM_HANDLER[0]
+	if callable(previous):
+		previous(signum,frame)
+	elif not previous == signal.SIG_IGN:
+		signal.signal(signal.SIGTERM,signal.SIG_DFL)
+		os.kill(os.getpid(),signal.SIGTERM)
+
+def _InstallSigterm():
+	if len(_SIGTERM_HANDLER) > 0:
+		return
+	try:
+		previous = signal.signal(signal.SIGTERM,_OnSigterm)
+	except ValueError:
+		return
+	_SIGTERM_HANDLER.append( previous )
+
+def CleanSharedCatalogs(scratch=None):
+	"""
+	Removes the SharedCatalog directories left by processes that no longer exist, e.g. killed by SIGKILL,
+	which can not be caught, so their files would stay on /dev/shm until reboot.
+
+	-Input:
+		scratch (str): the directory where the catalogs were created. If None, /dev/shm and the temporary directory.
+	-Output:
+		removed (list): the directories removed.
+	"""
+
+	if scratch is None:
+		scratch = [ dir_ for dir_ in ['/dev/shm',tempfile.gettempdir()] if os.path.isdir(dir_) ]
+	else:
+		scratch = [scratch]
+
+	removed = []
+	for dir_ in scratch:
+		for name_ in glob.glob(os.path.join(dir_,'magnipy_*_*')):
+			try:
+				pid_ = int(os.path.basename(name_).split('_')[1])
+			except ValueError:
+				continue
+			try:
+				os.kill(pid_,0)
+				continue
+			except OSError as error_:
+				if not error_.errno == errno.ESRCH:
+					continue
+			shutil.rmtree(name_,ignore_errors=True)
+			removed.append( name_ )
+
+	return removed
+
+def _FreeSpace(path):
+	stat = os.statvfs(path)
+	return stat.f_bavail*stat.f_frsize
+
+class SharedCatalog(object):
+	"""
+	A catalog whose columns are stored on memory-mapped files of a scratch directory, on /dev/shm (i.e. shared memory) if available.
+	Other processes attach to it by its name and get numpy views of the columns, with no copy. When pickled, e.g. as an argument
+	of a multiprocessing.Pool, only the name is serialised, so the memory used does not grow with the number of workers.
+	Only the process that created it removes the files: on Close, at the exit of a with statement, at exit of the interpreter
+	or on SIGTERM, so a failing worker never leaves the catalog half removed. A process killed by SIGKILL leaves its files behind,
+	use CleanSharedCatalogs to remove them.
+	It is meant to share a catalog with the workers of your own process pools. The functions of this package that run a pool fork
+	after building their inputs, so the workers inherit them. Only wutils.ReweightKNN and the pair-counting functions of wutils
+	(Get2pacf, Get2pacfBatch, CountPairsChunks, Get2pacfMap) accept a SharedCatalog as input, and they read it on the parent.
+	The masking and random-generation functions take plain arrays, to which its columns can be given, e.g. GetMaskArrays(files,cat['ra'],cat['dec']).
+
+	-Input:
+		columns (dict): the name and the array of each column, to create a new catalog.
+		name (str): the name of an existing catalog, to attach to it.
+		scratch (str): the directory where the catalog is created. By default /dev/shm if it exists and has room for the columns,
+			the temporary directory otherwise.
+		readonly (bool): if True, the views given when attached are read-only.
+	"""
+
+	def __init__(self,columns=None,name=None,scratch=None,readonly=True):
+		if columns is None and name is None:
+			raise ValueError('No columns nor name given.')
+
+		self.columns_ = {}
+
+		if name is None:
+			columns = dict( (key_,numpy.ascontiguousarray(array_)) for key_,array_ in columns.items() )
+			nbytes  = sum([ array_.nbytes for array_ in columns.values() ])
+
+			if scratch is None:
+				if os.path.isdir('/dev/shm') and _FreeSpace('/dev/shm') > nbytes:
+					scratch = '/dev/shm'
+				else:
+					scratch = tempfile.gettempdir()
+			if not _FreeSpace(scratch) > nbytes:
+				raise IOError('Not enough free space on '+scratch+' for '+str(nbytes)+' bytes.')
+
+			_InstallSigterm()
+			self.name_ = tempfile.mkdtemp(prefix='magnipy_'+str(os.getpid())+'_',dir=scratch)
+			_SHARED_OWNED[self.name_] = os.getpid()
+
+			try:
+				header = {}
+				for n_,(key_,array_) in enumerate(columns.items()):
+					file_ = 'column'+str(n_)
+					header[key_] = [file_,array_.dtype.str,list(array_.shape)]
+					if array_.size == 0:
+						continue
+					column_ = numpy.memmap(os.path.join(self.name_,file_),dtype=array_.dtype,mode='w+',shape=array_.shape)
+					column_[...] = array_
+					column_.flush()
+					del column_
+				with open(os.path.join(self.name_,'header.json'),'w') as file_:
+					json.dump(header,file_)
+			except:
+				self.Close()
+				raise
+
+			readonly = False
+		else:
+			self.name_ = name
+
+		with open(os.path.join(self.name_,'header.json')) as file_:
+			header = json.load(file_)
+
+		for key_,(file_,dtype_,shape_) in header.items():
+			dtype_ = numpy.dtype(str(dtype_))
+			if numpy.prod(shape_) == 0:
+				self.columns_[str(key_)] = numpy.zeros(tuple(shape_),dtype=dtype_)
+			else:
+				self.columns_[str(key_)] = numpy.memmap(os.path.join(self.name_,file_),dtype=dtype_,mode='r' if readonly else 'r+',shape=tuple(shape_))
+
+	def __getstate__(self):
+		return {'name':self.name_}
+
+	def __setstate__(self,state):
+		self.__init__(name=state['name'])
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.Close()
+
+	def __len__(self):
+		if len(self.columns_) == 0:
+			return 0
+		return len(list(self.columns_.values())[0])
+
+	def __contains__(self,key):
+		return key in self.columns_
+
+	def __getitem__(self,key):
+		return self.columns_[key]
+
+	def keys(self):
+		return list(self.columns_.keys())
+
+	def Close(self):
+		"""
+		Releases the views and, if called by the process that created the catalog, removes its files.
+		"""
+		self.columns_ = {}
+		if _SHARED_OWNED.get(self.name_) == os.getpid():
+			del _SHARED_OWNED[self.name_]
+			shutil.rmtree(self.name_,ignore_errors=True)
 
-	maskvalues = []
-	for ra_,dec_ in zip(ra,dec):
-		tht = numpy.pi/2.-dec_
-		phi = ra_
-		pix = healpy.ang2pix( nside,tht,phi,nest=isnest )
+_PIXCACHE = {}
 
-		maskvalues.append( mask[pix] )
+def _InitPixelCache(cache):
+	_PIXCACHE.clear()
+	_PIXCACHE.update(cache)
 
-	return maskvalues
+def _GatherMask(args):
+	filename,key = args
+	mask = healpy.read_map(filename,nest=key[1])
+	return mask[_PIXCACHE[key]]
 
-def Mask(filecat=None,filemask=[],maskname=[]):
+def GetMaskArrays(filemask=[],ra=[],dec=[],units='degrees',ncpu=None,pix=None,nside_pix=None):
+	"""
+	Given a a set of positons at the sky, returns for each mask an ordered array with the value of the mask at that position.
+	The pixel index of each position is computed only once, at the highest nside among the masks and on NESTED ordering.
+	Masks at a lower resolution reuse it by bit-shifting, and masks on RING ordering by a nest2ring conversion,
+	each one done once per (nside,ordering) group. The mask files are then read and gathered in parallel.
+	If a stored NESTED pixel index at least as fine as the masks is given (see AddPixelIndex), no ang2pix is done at all.
+
+	-Input:
+		filemask (list): List of the paths to the HEALPix masks.
+		ra (array): An array of floats containing the ra of each point of the sky.
+		dec (array): An array of floats containing the dec of each point of the sky.
+		units (str): Units of the input ra and dec. Degrees, arcmin or rad
+		ncpu (int): The number of processes used to read the masks.
+		pix (array): Optional. The NESTED pixel index of each point, used instead of ra and dec.
+		nside_pix (int): The nside of pix.
+
+	-Output:
+		masklist (list): a list containing, for each mask, an array with the value of the HEALPix mask on each point.
+	"""
+
+	if len(filemask) == 0:
+		raise ValueError('No mask given.')
+
+	headers = [ GetMaskHeader(file_) for file_ in filemask ]
+	nside   = max([ nside_ for nside_,isnest_ in headers ])
+
+	if pix is None or nside_pix < nside:
+		if len(ra) == 0:
+			raise ValueError('No ra given.')
+		if len(dec) == 0:
+			raise ValueError('No dec given.')
+		if not len(ra) == len(dec):
+			raise Exception('The size of the ra and dec arrays is different.')
+		if not units in ['degrees','radians','arcmin']:
+			raise ValueError('No recognized angular units.')
+		pix = GetPixelIndex(ra,dec,nside,nest=True,units=units)
+	else:
+		pix = ChangePixelResolution(numpy.asarray(pix),nside_pix,nside)
+
+	if ncpu is None:
+		ncpu = __NCPU__-1
+	elif not ncpu < __NCPU__:
+		ncpu = __NCPU__-1
+
+	cache = {}
+	for nside_,isnest_ in set(headers):
+		pix_ = ChangePixelResolution(pix,nside,nside_)
+		if not isnest_:
+			pix_ = healpy.nest2ring(nside_,pix_)
+		cache[(nside_,isnest_)] = pix_
+	del pix
+
+	jobs = list(zip(filemask,headers))
+
+	if ncpu < 2 or len(jobs) == 1:
+		_InitPixelCache(cache)
+		masklist = [ _GatherMask(job_) for job_ in jobs ]
+		_PIXCACHE.clear()
+		return masklist
+
+	pool = multiprocessing.Pool(processes=min(ncpu,len(jobs)),initializer=_InitPixelCache,initargs=(cache,))
+	try:
+		masklist = pool.map(_GatherMask,jobs,chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+	return masklist
+
+def GetMaskArray(filename=None,ra=[],dec=[],units='degrees'):
+
+	"""
+	Given a a set of positons at the sky, returns an ordered array with the value of the mask at that position.
+
+	-Input:
+		filename (str): The path to the HEALPix mask.
+		ra (array): An array of floats containing the ra of each point of the sky.
+		dec (array): An array of floats containing the dec of each point of the sky.
+		units (str): Units of the input ra and dec. Degrees, arcmin or rad
+
+	-Output:
+		maskvalues (list): a list containing the value of the HEALPIx mask on each point. 
+	"""
+
+	return list( GetMaskArrays([filename],ra,dec,units,ncpu=1)[0] )
+
+def Mask(filecat=None,filemask=[],maskname=[],ncpu=None):
 	"""
 	Given a Fits file, appends the value of the mask to the table fits on a new file 
 	-Input:
 		filecat (str): The name of the file with the catalog.
 		filemask (list): List of the names of the file with the mask.
 		maskname (list): List of the names of the new field
+		ncpu (int): The number of processes used to read the masks.
 	"""
 
 	if len(filemask) == 0:
@@ -112,14 +413,16 @@ def Mask(filecat=None,filemask=[],maskname=[]):
 	if not len(filemask) == len(maskname):
 		raise ValueError('The number of files and headers does not match.')
 
-	catalog       = fits.open(filecat)[1].data
-	columnnames   = fits.open(filecat)[1].columns.names
-	columnformats = fits.open(filecat)[1].columns.formats
-
-	masklist = []
-	for file_ in filemask:
-		masklist.append( GetMaskArray(file_,catalog['ra'],catalog['dec']) )
+	hdulist       = fits.open(filecat)
+	catalog       = hdulist[1].data
+	header        = hdulist[1].header
+	columnnames   = hdulist[1].columns.names
+	columnformats = hdulist[1].columns.formats
 
+	if 'HPXNSIDE' in header:
+		masklist = GetMaskArrays(filemask,catalog['ra'],catalog['dec'],ncpu=ncpu,pix=catalog[header['HPXCOL']],nside_pix=header['HPXNSIDE'])
+	else:
+		masklist = GetMaskArrays(filemask,catalog['ra'],catalog['dec'],ncpu=ncpu)
 
 	columns  = [ catalog[col_] for col_ in columnnames ]
 	columns       += masklist
@@ -130,8 +433,211 @@ def Mask(filecat=None,filemask=[],maskname=[]):
 
 	cols  = fits.ColDefs(columnlist)
 	tbhdu = fits.BinTableHDU.from_columns(cols)
-	tbhdu.writeto(filecat+'_'.join(maskname))
 
+	if 'HPXNSIDE' in header:
+		for key_ in ['HPXNSIDE','HPXCOL','HPXSORT']:
+			tbhdu.header[key_] = header[key_]
+	if header.get('HPXSORT',False):
+		fits.HDUList([fits.PrimaryHDU(),tbhdu,hdulist['PIXINDEX']]).writeto(filecat+'_'.join(maskname))
+	else:
+		tbhdu.writeto(filecat+'_'.join(maskname))
+
+
+def AddPixelIndex(filecat=None,nside=None,colname='HPIX',sort=True):
+	"""
+	Appends to a catalog a column with the NESTED HEALPix pixel index of each object and writes it on a new file.
+	If sort, the rows are sorted by that pixel, so that each pixel and each of its parents at a coarser nside
+	is a contiguous range of rows, and an offset index (pixel -> first row, last row + 1) is written on
+	an extension named PIXINDEX. The nside and column name are stored on the keywords HPXNSIDE and HPXCOL.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+		nside (int): The nside of the pixel index.
+		colname (str): The name of the new column.
+		sort (bool): If True, sort the rows by pixel and write the offset index.
+	-Output:
+		tbhdu (BinTableHDU): The BinTable with the new column.
+	"""
+
+	if nside is None:
+		raise ValueError('No nside given.')
+
+	catalog       = fits.open(filecat)[1].data
+	columnnames   = fits.open(filecat)[1].columns.names
+	columnformats = fits.open(filecat)[1].columns.formats
+
+	if colname in columnnames:
+		raise ValueError('The name '+colname+' is already present.')
+
+	pix = GetPixelIndex(catalog['ra'],catalog['dec'],nside,nest=True)
+
+	if sort:
+		order   = numpy.argsort(pix,kind='mergesort')
+		pix     = pix[order]
+		columns = [ catalog[col_][order] for col_ in columnnames ]
+	else:
+		columns = [ catalog[col_] for col_ in columnnames ]
+
+	columns       += [pix]
+	columnnames   += [colname]
+	columnformats += ['K']
+
+	columnlist = map(lambda name_,format_,array_: fits.Column( name=name_,format=format_,array=array_ ),columnnames,columnformats,columns)
+
+	cols  = fits.ColDefs(columnlist)
+	tbhdu = fits.BinTableHDU.from_columns(cols)
+	tbhdu.header['HPXNSIDE'] = nside
+	tbhdu.header['HPXCOL']   = colname
+	tbhdu.header['HPXSORT']  = sort
+
+	if not sort:
+		tbhdu.writeto(filecat+'_'+colname)
+		return tbhdu
+
+	pixels,start = numpy.unique(pix,return_index=True)
+	stop = numpy.append(start[1:],len(pix))
+
+	index = fits.BinTableHDU.from_columns(fits.ColDefs([
+		fits.Column(name='PIXEL',format='K',array=pixels),
+		fits.Column(name='START',format='K',array=start),
+		fits.Column(name='STOP' ,format='K',array=stop)]),name='PIXINDEX')
+	index.header['HPXNSIDE'] = nside
+
+	fits.HDUList([fits.PrimaryHDU(),tbhdu,index]).writeto(filecat+'_'+colname)
+
+	return tbhdu
+
+def GetPixelOffsets(filecat=None):
+	"""
+	Reads the offset index of a catalog sorted by AddPixelIndex.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+	-Output:
+		nside (int): The nside of the pixel index.
+		pixels (array): The NESTED pixels with at least one object, sorted.
+		start (array): The first row of each pixel.
+		stop (array): The last row plus one of each pixel.
+	"""
+
+	hdulist = fits.open(filecat)
+	if not hdulist[1].header.get('HPXSORT',False):
+		raise Exception('The catalog '+filecat+' is not sorted by pixel. Use AddPixelIndex first.')
+
+	index = hdulist['PIXINDEX'].data
+	return int(hdulist['PIXINDEX'].header['HPXNSIDE']),index['PIXEL'],index['START'],index['STOP']
+
+def GetPixelRows(filecat=None,pixels=[],nside=None):
+	"""
+	Gives the row ranges of a pixel-sorted catalog that fall on a set of NESTED pixels.
+	Pixels coarser than those of the catalog cover a contiguous range of catalog pixels, hence of rows.
+	Pixels finer than those of the catalog are degraded to it, so the selection is then a superset.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+		pixels (array): The NESTED pixels to select.
+		nside (int): The nside of pixels.
+	-Output:
+		ranges (list): A sorted list of non overlapping (start,stop) row ranges.
+	"""
+
+	nside_cat,pix_cat,start,stop = GetPixelOffsets(filecat)
+
+	pixels = numpy.unique(numpy.asarray(pixels,dtype=numpy.int64))
+	if nside > nside_cat:
+		pixels = numpy.unique(ChangePixelResolution(pixels,nside,nside_cat))
+		nside  = nside_cat
+
+	shift = 2*int(round(math.log(float(nside_cat)/nside,2)))
+	first = numpy.searchsorted(pix_cat,numpy.left_shift(pixels  ,shift),side='left')
+	last  = numpy.searchsorted(pix_cat,numpy.left_shift(pixels+1,shift),side='left')
+
+	ranges = []
+	for first_,last_ in zip(first,last):
+		if first_ == last_:
+			continue
+		if len(ranges) > 0 and ranges[-1][1] == start[first_]:
+			ranges[-1] = (ranges[-1][0],stop[last_-1])
+		else:
+			ranges.append( (start[first_],stop[last_-1]) )
+
+	return ranges
+
+def SelectPixels(filecat=None,pixels=[],nside=None):
+	"""
+	Reads from a pixel-sorted catalog only the rows that fall on a set of NESTED pixels.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+		pixels (array): The NESTED pixels to select.
+		nside (int): The nside of pixels.
+	-Output:
+		data (structured array): The selected rows.
+	"""
+
+	ranges  = GetPixelRows(filecat,pixels,nside)
+	catalog = fits.open(filecat,memmap=True)[1].data
+
+	if len(ranges) == 0:
+		return numpy.asarray(catalog[:0])
+
+	return numpy.concatenate([ numpy.asarray(catalog[start_:stop_]) for start_,stop_ in ranges ])
+
+def SelectFootprint(filecat=None,filemask=None):
+	"""
+	Reads from a pixel-sorted catalog only the rows inside the footprint of a HEALPix mask, that is where the mask is above 0.
+	If the mask is finer than the pixel index of the catalog, the rows of the catalog pixels fully inside the footprint are taken as they are,
+	and those of the pixels only partly inside are checked against the mask at its own nside.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+		filemask (str): The path to the HEALPix mask.
+	-Output:
+		data (structured array): The selected rows, sorted by pixel.
+	"""
+
+	nside,isnest = GetMaskHeader(filemask)
+	inside = healpy.read_map(filemask,nest=True) > 0
+
+	nside_cat = int(fits.open(filecat)[1].header['HPXNSIDE'])
+	if not nside > nside_cat:
+		return SelectPixels(filecat,numpy.where(inside)[0],nside)
+
+	children = inside.reshape([healpy.nside2npix(nside_cat),-1])
+	full     = numpy.where(children.all(axis=1))[0]
+	partial  = numpy.where(children.any(axis=1) & ~children.all(axis=1))[0]
+
+	data     = SelectPixels(filecat,full,nside_cat)
+	boundary = SelectPixels(filecat,partial,nside_cat)
+	boundary = boundary[inside[GetPixelIndex(boundary['ra'],boundary['dec'],nside,nest=True)]]
+
+	data  = numpy.concatenate([data,boundary])
+	order = numpy.argsort(data[fits.open(filecat)[1].header['HPXCOL']],kind='mergesort')
+
+	return data[order]
+
+def GetPatches(filecat=None,nside=None):
+	"""
+	Splits a pixel-sorted catalog in patches, each one a NESTED pixel at a coarser nside, to be used on resampling.
+	As the catalog is sorted, each patch is a contiguous range of rows.
+
+	-Input:
+		filecat (str): The name of the file with the catalog.
+		nside (int): The nside of the patches.
+	-Output:
+		patches (array): The NESTED pixel of each non empty patch.
+		ranges (list): The (start,stop) row range of each patch.
+	"""
+
+	nside_cat,pix_cat,start,stop = GetPixelOffsets(filecat)
+
+	parent = ChangePixelResolution(pix_cat,nside_cat,nside)
+	patches,first = numpy.unique(parent,return_index=True)
+	last = numpy.append(first[1:],len(parent))
+
+	ranges = [ (start[first_],stop[last_-1]) for first_,last_ in zip(first,last) ]
+
+	return patches,ranges
 
 def GetMasterMask(logic=None,*arg):
 	"""
@@ -1,10 +1,14 @@
 from astropy.io import fits
-import healpy, numpy, math, multiprocessing, sklearn, collections
-import catutils
+import healpy, numpy, math, multiprocessing, sklearn, collections, treecorr, hashlib, os, warnings
+import catutils, magnipy
 from ROOT import *
 
 __NCPU__ = multiprocessing.cpu_count()
 
+__NBINS__  = 6
+__MINSEP__ = 0.01
+__MAXSEP__ = 1.0
+
 def DoRandomFlat(N=1,ra=[],dec=[],masks=[],masknames=[]):
 	"""
 	Creates an BinTable with uniform distributed points trough space with mask values appended.
@@ -30,8 +34,8 @@ def DoRandomFlat(N=1,ra=[],dec=[],masks=[],masknames=[]):
 		dec_r.append( dec_tmp )
 
 	mask_array = []
-	for filemask_ in masks:
-		mask_array.append( catutils.GetMaskArray(filemask_,ra=ra_r,dec=dec_r) )	
+	if len(masks) > 0:
+		mask_array = catutils.GetMaskArrays(masks,ra=ra_r,dec=dec_r)
 
 	colnames = ['ra','dec']+masknames
 	types    = ['E']*len(colnames)
@@ -48,8 +52,8 @@ def ReweightKNN(array_to_match,array_to_reweight,keys,nn=100,ncpu=None):
 	Computes the weights of an given a table with N objects on an k-dim space with the KNN approach.
 	The weights are computed such that the k-dim space of M objects of another reference table.
 	-Input:
-		array_to_match (structured array): The reference table.
-		array_to_reweight (structured array): The array for which the weights are going to be computed.
+		array_to_match (structured array or catutils.SharedCatalog): The reference table.
+		array_to_reweight (structured array or catutils.SharedCatalog): The array for which the weights are going to be computed.
 		keys (list of str): the names of the fields of the array that will compose the k-dim space.
 		nn (int): the number of nearest neighbors.
 	-Output:
@@ -78,11 +82,22 @@ def ReweightKNN(array_to_match,array_to_reweight,keys,nn=100,ncpu=None):
 
 	return w_norm
 
+def _GetColumns(sample):
+	"""
+	Gives a sample as [ra,dec] or [ra,dec,weight]. A catutils.SharedCatalog is read from its columns ra, dec and, if present, weight.
+	"""
+	if isinstance(sample,catutils.SharedCatalog):
+		if 'weight' in sample:
+			return [sample['ra'],sample['dec'],sample['weight']]
+		return [sample['ra'],sample['dec']]
+	return sample
+
 def Get2pacf(data_lens=[],data_sour=None,rand_lens=[],rand_sour=None):
 	"""
 	Computes the 2pacf density-density cross/auto-correlation.
 	-Input:
 		data_lens (list): a list containing [ra,dec,weight] for the lens. If weight is not provided, ti will be assumed as 1.
+				  Each sample can also be a catutils.SharedCatalog with the columns ra, dec and, optionally, weight.
 		data_sour (list): a list containing [ra,dec,weight] for the source. If weight is not provided, ti will be assumed as 1.
 				  if None, the auto-correlation will be computed instead of the cross.
 		rand_lens (list): a list containing [ra,dec,weight] for the random sample associated with the lens.
@@ -93,6 +108,11 @@ def Get2pacf(data_lens=[],data_sour=None,rand_lens=[],rand_sour=None):
 		
 	"""
 
+	data_lens = _GetColumns(data_lens)
+	data_sour = _GetColumns(data_sour)
+	rand_lens = _GetColumns(rand_lens)
+	rand_sour = _GetColumns(rand_sour)
+
 	if len(data_lens) == 2:
 		lens_cat = treecorr.Catalog(ra=data_lens[0],dec=data_lens[1],ra_units='degrees',dec_units='degrees')
 	elif len(data_lens) == 3:
@@ -129,10 +149,10 @@ def Get2pacf(data_lens=[],data_sour=None,rand_lens=[],rand_sour=None):
 		raise ValueError('Too many lens parameters.')
 
 
-	dd = treecorr.NNCorrelation(nbins=6,min_sep=0.01,max_sep=1.0,sep_units='degrees')
-	dr = treecorr.NNCorrelation(nbins=6,min_sep=0.01,max_sep=1.0,sep_units='degrees')
-	rd = treecorr.NNCorrelation(nbins=6,min_sep=0.01,max_sep=1.0,sep_units='degrees')
-	rr = treecorr.NNCorrelation(nbins=6,min_sep=0.01,max_sep=1.0,sep_units='degrees')
+	dd = treecorr.NNCorrelation(nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,sep_units='degrees')
+	dr = treecorr.NNCorrelation(nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,sep_units='degrees')
+	rd = treecorr.NNCorrelation(nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,sep_units='degrees')
+	rr = treecorr.NNCorrelation(nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,sep_units='degrees')
 
 	dd.process(lens_cat,sour_cat)
 	dr.process(lens_cat,sour_rnd)
@@ -143,3 +163,602 @@ def Get2pacf(data_lens=[],data_sour=None,rand_lens=[],rand_sour=None):
 	th = dd.meanr
 
 	return xi,th
+
+def _GetCatalog(sample):
+	sample = _GetColumns(sample)
+	if len(sample) == 2:
+		return treecorr.Catalog(ra=sample[0],dec=sample[1],ra_units='degrees',dec_units='degrees')
+	elif len(sample) == 3:
+		return treecorr.Catalog(ra=sample[0],dec=sample[1],w=sample[2],ra_units='degrees',dec_units='degrees')
+	else:
+		raise ValueError('Too many sample parameters.')
+
+_TREECORR_FIELDS = ((4,0),(5,1))
+
+def _BuildFields(catalogs,config):
+	"""
+	Builds the tree of each catalog with the sizes NNCorrelation.process uses for config, filling the field cache of the catalog.
+	Called before a process pool forks, so that every worker inherits the trees instead of building its own.
+	It relies on treecorr internals, NNCorrelation._set_metric and _get_minmax_size and the arguments process gives to Catalog.getNField,
+	so it requires treecorr 4.0 to 5.1. On other versions, or if those internals are missing, it warns and every worker builds its own trees.
+	"""
+
+	try:
+		version = tuple( [ int(v_) for v_ in treecorr.__version__.split('.')[:2] ] )
+	except ValueError:
+		version = None
+	if version is None or not _TREECORR_FIELDS[0] <= version <= _TREECORR_FIELDS[1]:
+		warnings.warn('treecorr '+treecorr.__version__+' is not supported to build the trees before forking, each worker will build its own.')
+		return
+
+	nn = treecorr.NNCorrelation(**config)
+	for cat_ in catalogs:
+		try:
+			nn._set_metric(None,cat_.coords,cat_.coords)
+			min_size,max_size = nn._get_minmax_size()
+		except (AttributeError,TypeError) as error_:
+			warnings.warn('Can not build the trees before forking ('+str(error_)+'), each worker will build its own.')
+			return
+		cat_.getNField(min_size=min_size,max_size=max_size,split_method=nn.split_method,brute=False,
+		               min_top=nn.min_top,max_top=nn.max_top,coords=nn.coords)
+
+_BATCH_CATALOGS = []
+_BATCH_CONFIG   = {}
+
+def _CountPairs(job):
+	k1,k2 = job
+	nn = treecorr.NNCorrelation(**_BATCH_CONFIG)
+	nn.process(_BATCH_CATALOGS[k1],_BATCH_CATALOGS[k2])
+	return job,nn
+
+def Get2pacfBatch(data_lens=[],data_sour=None,rand_lens=[],rand_sour=None,ncpu=None):
+	"""
+	Computes the 2pacf density-density cross-correlation for every lens bin - source bin pair.
+	Each catalog and its tree are built only once, before the process pool forks, samples passed more than once (e.g. a random shared
+	by several bins) are built once too, and so are the DD/DR/RD/RR jobs that they share. The jobs are run on the process pool,
+	the largest, by expected pair count, first. The binning and the errors are the same as those of Get2pacf.
+	-Input:
+		data_lens (list): a list with one [ra,dec,weight] per lens bin. If weight is not provided, it will be assumed as 1.
+				  Each sample can also be a catutils.SharedCatalog with the columns ra, dec and, optionally, weight.
+		data_sour (list): a list with one [ra,dec,weight] per source bin.
+				  if None, the auto- and cross-correlations between the lens bins will be computed instead.
+		rand_lens (list): a list with one [ra,dec,weight] per lens bin for the random sample associated with it.
+		rand_sour (list): a list with one [ra,dec,weight] per source bin for the random sample associated with it.
+		ncpu (int): The number of processes.
+	-Output:
+		w (list): a list of lists such that w[i][j] is a magnipy.DataW with the 2pacf of lens bin i and source bin j.
+	"""
+
+	if ncpu is None:
+		ncpu = __NCPU__-1
+	elif not ncpu < __NCPU__:
+		ncpu = __NCPU__-1
+
+	if not len(data_lens) == len(rand_lens):
+		raise ValueError('The number of lens data and random samples is different.')
+	if data_sour is None and not rand_sour is None:
+		raise Exception('Not data of sources provided')
+	if rand_sour is None and not data_sour is None:
+		raise Exception('Not rand of sources provided')
+
+	isauto = data_sour is None
+	if isauto:
+		data_sour = data_lens
+		rand_sour = rand_lens
+	elif not len(data_sour) == len(rand_sour):
+		raise ValueError('The number of source data and random samples is different.')
+
+	samples = []
+	def key(sample):
+		for k_,sample_ in enumerate(samples):
+			if sample_ is sample:
+				return k_
+		samples.append( sample )
+		return len(samples)-1
+
+	pairs = {}
+	for i_ in range(len(data_lens)):
+		for j_ in range(len(data_sour)):
+			if isauto and j_ < i_:
+				continue
+			pairs[(i_,j_)] = ( (key(data_lens[i_]),key(data_sour[j_])),
+			                   (key(data_lens[i_]),key(rand_sour[j_])),
+			                   (key(rand_lens[i_]),key(data_sour[j_])),
+			                   (key(rand_lens[i_]),key(rand_sour[j_])) )
+
+	del _BATCH_CATALOGS[:]
+	_BATCH_CATALOGS.extend( [ _GetCatalog(sample_) for sample_ in samples ] )
+	_BATCH_CONFIG.clear()
+	_BATCH_CONFIG.update( nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,sep_units='degrees' )
+
+	jobs = set()
+	for jobs_ in pairs.values():
+		jobs.update( jobs_ )
+	jobs = sorted(jobs,key=lambda job_: -float(_BATCH_CATALOGS[job_[0]].nobj)*_BATCH_CATALOGS[job_[1]].nobj)
+
+	try:
+		_BuildFields(_BATCH_CATALOGS,_BATCH_CONFIG)
+		if ncpu < 2 or len(jobs) == 1:
+			counts = [ _CountPairs(job_) for job_ in jobs ]
+		else:
+			_BATCH_CONFIG['num_threads'] = 1
+			pool = multiprocessing.Pool(processes=min(ncpu,len(jobs)))
+			try:
+				counts = list( pool.imap_unordered(_CountPairs,jobs,chunksize=1) )
+			finally:
+				pool.close()
+				pool.join()
+	finally:
+		del _BATCH_CATALOGS[:]
+		_BATCH_CONFIG.clear()
+	counts = dict( counts )
+
+	w = [ [ None for _ in data_sour ] for _ in data_lens ]
+	for (i_,j_),(dd_,dr_,rd_,rr_) in pairs.items():
+		xi,var = counts[dd_].calculateXi(rr=counts[rr_],dr=counts[dr_],rd=counts[rd_])
+
+		w_ = magnipy.DataW(name='lens'+str(i_)+'_sour'+str(j_))
+		w_.angle_ = numpy.array(counts[dd_].meanr)
+		w_.w_     = numpy.array(xi)
+		w_.error_ = numpy.sqrt(var)
+		w_.Nth_   = len(xi)
+		w_.SetDiagonalCovariance()
+
+		w[i_][j_] = w_
+		if isauto:
+			w[j_][i_] = w_
+
+	return w
+
+def _SumWeights(sample):
+	sample = _GetColumns(sample)
+	if len(sample) == 3:
+		return float(numpy.sum(sample[2]))
+	return float(len(sample[0]))
+
+def _GetSignature(*samples):
+	sha = hashlib.sha1()
+	for sample_ in samples:
+		for col_ in _GetColumns(sample_):
+			sha.update( numpy.ascontiguousarray(col_,dtype=numpy.float64).tobytes() )
+	return sha.hexdigest()
+
+class PairCounts(object):
+	"""
+	Accumulator of the raw weighted DD/DR/RD/RR pair counts of a lens-source 2pacf, with the lens and source samples split in named chunks (e.g. sky tiles).
+	The counts are stored for each (lens chunk, source chunk) pair, keyed by the signatures of the data of both chunks, along with the total weights of each chunk.
+	So a new or changed chunk only needs to be counted against the chunks of the other side, and accumulators filled by different runs (e.g. one per node)
+	are merged by adding the pairs counted on each. The Landy-Szalay 2pacf can be derived at any point from the pairs of chunks already counted.
+	-Input:
+		nbins (int), min_sep (float), max_sep (float): the binning, with the separations in degrees.
+		bin_slop (float): the treecorr bin_slop. If None, the treecorr default, as on Get2pacf.
+			Set it to 0 for the sum over the chunks to be the same as a single run on the full samples, at the price of a much slower counting.
+	"""
+
+	def __init__(self,nbins=__NBINS__,min_sep=__MINSEP__,max_sep=__MAXSEP__,bin_slop=None):
+		self.nbins_    = nbins
+		self.min_sep_  = min_sep
+		self.max_sep_  = max_sep
+		self.bin_slop_ = bin_slop
+		self.lens_     = {}
+		self.sour_     = {}
+		self.weights_  = {}
+		self.pairs_    = {}
+
+	def __len__(self):
+		return len(self.pairs_)
+
+	def __iadd__(self,other):
+		if not self.GetBinning() == other.GetBinning():
+			raise ValueError('The binning of the pair counts does not match.')
+
+		for mine_,theirs_ in [(self.lens_,other.lens_),(self.sour_,other.sour_)]:
+			for chunk_,signature_ in theirs_.items():
+				if chunk_ in mine_ and not mine_[chunk_] == signature_:
+					raise ValueError('The chunk '+chunk_+' has different data on each pair counts.')
+			mine_.update( theirs_ )
+		self.weights_.update( other.weights_ )
+
+		for pair_,counts_ in other.pairs_.items():
+			if self.GetPair(*pair_) is None:
+				self.pairs_[pair_] = numpy.array(counts_)
+		return self
+
+	def __add__(self,other):
+		result = PairCounts(*self.GetBinning())
+		result += self
+		result += other
+		return result
+
+	def GetBinning(self):
+		return (self.nbins_,self.min_sep_,self.max_sep_,self.bin_slop_)
+
+	def GetConfig(self):
+		"""
+		Gives the treecorr NNCorrelation configuration of the binning.
+		"""
+		config = dict( nbins=self.nbins_,min_sep=self.min_sep_,max_sep=self.max_sep_,sep_units='degrees' )
+		if not self.bin_slop_ is None:
+			config['bin_slop'] = self.bin_slop_
+		return config
+
+	def SetChunks(self,lens=[],sour=[]):
+		"""
+		Sets the current chunks of each side, each one as (name,signature,wdata,wrand) with wdata and wrand the total weights of its data and random.
+		The counts of pairs of chunks that are no longer current are dropped, those of the rest are kept.
+		"""
+		self.lens_ = dict( (str(chunk_),signature_) for chunk_,signature_,wdata_,wrand_ in lens )
+		self.sour_ = dict( (str(chunk_),signature_) for chunk_,signature_,wdata_,wrand_ in sour )
+		for chunk_,signature_,wdata_,wrand_ in list(lens)+list(sour):
+			self.weights_[signature_] = numpy.array([wdata_,wrand_],dtype=numpy.float64)
+
+		lens_ = set(self.lens_.values())
+		sour_ = set(self.sour_.values())
+		for pair_ in list(self.pairs_.keys()):
+			if not ( (pair_[0] in lens_ and pair_[1] in sour_) or (pair_[1] in lens_ and pair_[0] in sour_) ):
+				del self.pairs_[pair_]
+		for signature_ in list(self.weights_.keys()):
+			if not (signature_ in lens_ or signature_ in sour_):
+				del self.weights_[signature_]
+
+	def AddPair(self,lens,sour,counts):
+		"""
+		Stores the counts of the pair of chunks with signatures lens and sour, as a (10,nbins) array with the weights of DD, DR, RD and RR,
+		their number of pairs, and the DD-weighted sums of the separation and of its logarithm.
+		"""
+		self.pairs_[(lens,sour)] = numpy.array(counts,dtype=numpy.float64).reshape([10,self.nbins_])
+
+	def GetPair(self,lens,sour):
+		"""
+		Gives the (10,nbins) counts of a pair of chunks, as given to AddPair, or None if not counted.
+		As the pairs are symmetric, the counts of (sour,lens) give those of (lens,sour) by swapping DR and RD.
+		"""
+		if (lens,sour) in self.pairs_:
+			return self.pairs_[(lens,sour)]
+		if (sour,lens) in self.pairs_:
+			return self.pairs_[(sour,lens)][[0,2,1,3,4,6,5,7,8,9]]
+		return None
+
+	def GetMissing(self):
+		"""
+		Gives the (lens,sour) signatures of the pairs of current chunks not counted yet. Of two mirrored pairs only one is given.
+		"""
+		missing = []
+		listed  = set()
+		for lens_ in sorted(set(self.lens_.values())):
+			for sour_ in sorted(set(self.sour_.values())):
+				if self.GetPair(lens_,sour_) is None and not (sour_,lens_) in listed:
+					missing.append( (lens_,sour_) )
+					listed.add( (lens_,sour_) )
+		return missing
+
+	def GetCounts(self):
+		"""
+		Sums the counts over the pairs of current chunks already counted.
+		-Output:
+			counts (array): a (10,nbins) array with the summed counts, as given to AddPair.
+			tot (array): the normalisations of DD, DR, RD and RR, that is the sum of the products of the total weights of the counted pairs of chunks.
+		"""
+		counts = numpy.zeros([10,self.nbins_])
+		tot    = numpy.zeros([4])
+		for lens_ in self.lens_.values():
+			for sour_ in self.sour_.values():
+				counts_ = self.GetPair(lens_,sour_)
+				if counts_ is None:
+					continue
+				(wdl,wrl),(wds,wrs) = self.weights_[lens_],self.weights_[sour_]
+				counts += counts_
+				tot    += [wdl*wds,wdl*wrs,wrl*wds,wrl*wrs]
+		return counts,tot
+
+	def GetXi(self):
+		"""
+		Loads the summed counts on treecorr NNCorrelation objects and computes the Landy-Szalay 2pacf with calculateXi, as Get2pacf does.
+		The bins without RR pairs are given as NaN.
+		-Output:
+			xi (list): a list (xi,varxi) such that xi contains the value of the 2pacf and varxi its variance.
+			th (array): the DD-weighted mean angle of each bin.
+		"""
+		counts,tot = self.GetCounts()
+		if tot[0] == 0:
+			raise Exception('No pair of chunks has been counted.')
+
+		dd,dr,rd,rr = [ treecorr.NNCorrelation(**self.GetConfig()) for _ in range(4) ]
+		for k_,nn_ in enumerate([dd,dr,rd,rr]):
+			nn_.weight[:] = counts[k_]
+			nn_.npairs[:] = counts[4+k_]
+			nn_.tot       = tot[k_]
+
+		good = counts[0] > 0
+		dd.meanr[good]    = counts[8][good]/counts[0][good]
+		dd.meanlogr[good] = counts[9][good]/counts[0][good]
+
+		xi,var = dd.calculateXi(rr=rr,dr=dr,rd=rd)
+		xi,var = numpy.array(xi),numpy.array(var)
+		xi[counts[3] == 0]  = numpy.nan
+		var[counts[3] == 0] = numpy.nan
+
+		return (xi,var),numpy.array(dd.meanr)
+
+	def GetDataW(self,name=''):
+		"""
+		Gives the 2pacf as a magnipy.DataW, without the bins that have no RR pairs.
+		"""
+		(xi,var),th = self.GetXi()
+		good = numpy.isfinite(xi)
+
+		w = magnipy.DataW(name=name)
+		w.angle_ = th[good]
+		w.w_     = xi[good]
+		w.error_ = numpy.sqrt(var[good])
+		w.Nth_   = len(w.w_)
+		w.SetDiagonalCovariance()
+		return w
+
+	def Write(self,path):
+		"""
+		Writes the pair counts as a numpy .npz checkpoint. The file is replaced atomically, so a run killed while writing keeps the previous one.
+		"""
+		lens    = sorted(self.lens_.keys())
+		sour    = sorted(self.sour_.keys())
+		weights = sorted(self.weights_.keys())
+		pairs   = sorted(self.pairs_.keys())
+
+		with open(path+'.tmp','wb') as file_:
+			numpy.savez(file_,
+				binning      = numpy.array([self.nbins_,self.min_sep_,self.max_sep_,numpy.nan if self.bin_slop_ is None else self.bin_slop_],dtype=numpy.float64),
+				lens         = numpy.array(lens,dtype=str),
+				lens_sig     = numpy.array([ self.lens_[chunk_] for chunk_ in lens ],dtype=str),
+				sour         = numpy.array(sour,dtype=str),
+				sour_sig     = numpy.array([ self.sour_[chunk_] for chunk_ in sour ],dtype=str),
+				weights_sig  = numpy.array(weights,dtype=str),
+				weights      = numpy.array([ self.weights_[signature_] for signature_ in weights ]).reshape([len(weights),2]),
+				pairs_lens   = numpy.array([ pair_[0] for pair_ in pairs ],dtype=str),
+				pairs_sour   = numpy.array([ pair_[1] for pair_ in pairs ],dtype=str),
+				pairs        = numpy.array([ self.pairs_[pair_] for pair_ in pairs ]).reshape([len(pairs),10,self.nbins_]) )
+		os.rename(path+'.tmp',path)
+
+	def Read(self,path):
+		data = numpy.load(path)
+
+		self.nbins_    = int(data['binning'][0])
+		self.min_sep_  = float(data['binning'][1])
+		self.max_sep_  = float(data['binning'][2])
+		self.bin_slop_ = None if numpy.isnan(data['binning'][3]) else float(data['binning'][3])
+		self.lens_     = dict( (str(chunk_),str(signature_)) for chunk_,signature_ in zip(data['lens'],data['lens_sig']) )
+		self.sour_     = dict( (str(chunk_),str(signature_)) for chunk_,signature_ in zip(data['sour'],data['sour_sig']) )
+		self.weights_  = dict( (str(signature_),numpy.array(weights_)) for signature_,weights_ in zip(data['weights_sig'],data['weights']) )
+		self.pairs_    = dict( ((str(lens_),str(sour_)),numpy.array(counts_)) for lens_,sour_,counts_ in zip(data['pairs_lens'],data['pairs_sour'],data['pairs']) )
+
+def _CountPairsChunk(job):
+	k1,k2 = job
+	nn = treecorr.NNCorrelation(**_BATCH_CONFIG)
+	nn.process(_BATCH_CATALOGS[k1],_BATCH_CATALOGS[k2])
+	weight = numpy.array(nn.weight)
+	return job,weight,numpy.array(nn.npairs),numpy.array(nn.meanr)*weight,numpy.array(nn.meanlogr)*weight
+
+def CountPairsChunks(counts=None,lens_chunks=[],sour_chunks=None,checkpoint=None,ncpu=None):
+	"""
+	Counts the DD/DR/RD/RR pairs of every lens chunk - source chunk pair not counted yet, i.e. those involving a new or changed chunk.
+	With the bin_slop of counts at 0 and chunks of each side that do not overlap, the sum over the chunks is the same as a single run on the full samples.
+	With the default bin_slop, that of Get2pacf, it is the same up to the binning approximation of treecorr, and the counting is much faster.
+	-Input:
+		counts (PairCounts): the accumulator to update. If None, a new one is created, or read from checkpoint if it exists.
+		lens_chunks (list): a list of (name,data_lens,rand_lens) with data_lens and rand_lens as [ra,dec,weight] or as catutils.SharedCatalog.
+				    If weight is not provided, it will be assumed as 1.
+		sour_chunks (list): a list of (name,data_sour,rand_sour) for the source. If None, the auto-correlation of the lens will be computed instead.
+		checkpoint (str): if given, the path where the accumulator is written each time a pair of chunks is finished.
+		ncpu (int): The number of processes.
+	-Output:
+		counts (PairCounts): the updated accumulator.
+	"""
+
+	if ncpu is None:
+		ncpu = __NCPU__-1
+	elif not ncpu < __NCPU__:
+		ncpu = __NCPU__-1
+
+	if len(lens_chunks) == 0:
+		raise ValueError('No lens chunk given.')
+	if sour_chunks is None:
+		sour_chunks = lens_chunks
+
+	if counts is None:
+		counts = PairCounts()
+		if not checkpoint is None and os.path.exists(checkpoint):
+			counts.Read(checkpoint)
+
+	samples = {}
+	def describe(chunks):
+		described = []
+		for chunk_,data_,rand_ in chunks:
+			signature_ = _GetSignature(data_,rand_)
+			samples[signature_] = (data_,rand_)
+			described.append( (chunk_,signature_,_SumWeights(data_),_SumWeights(rand_)) )
+		return described
+
+	lens = describe(lens_chunks)
+	sour = lens if sour_chunks is lens_chunks else describe(sour_chunks)
+	counts.SetChunks(lens,sour)
+
+	missing = counts.GetMissing()
+	if len(missing) == 0:
+		return counts
+
+	keys = {}
+	del _BATCH_CATALOGS[:]
+	for signature_ in set( [ sig_ for pair_ in missing for sig_ in pair_ ] ):
+		keys[signature_] = (len(_BATCH_CATALOGS),len(_BATCH_CATALOGS)+1)
+		_BATCH_CATALOGS.extend( [ _GetCatalog(sample_) for sample_ in samples[signature_] ] )
+
+	owner = {}
+	for n_,(lens_,sour_) in enumerate(missing):
+		(dl,rl),(ds,rs) = keys[lens_],keys[sour_]
+		for slot_,job_ in enumerate([(dl,ds),(dl,rs),(rl,ds),(rl,rs)]):
+			owner.setdefault( tuple(sorted(job_)),[] ).append( (n_,slot_) )
+	jobs = sorted(owner.keys(),key=lambda job_: -float(_BATCH_CATALOGS[job_[0]].nobj)*_BATCH_CATALOGS[job_[1]].nobj)
+
+	partial = [ [None]*10 for _ in missing ]
+	def collect(result):
+		job_,weight_,npairs_,rsum_,logrsum_ = result
+		for n_,slot_ in owner[job_]:
+			partial[n_][slot_]   = weight_
+			partial[n_][4+slot_] = npairs_
+			if slot_ == 0:
+				partial[n_][8] = rsum_
+				partial[n_][9] = logrsum_
+			if all( [ not p_ is None for p_ in partial[n_] ] ):
+				counts.AddPair(missing[n_][0],missing[n_][1],partial[n_])
+				if not checkpoint is None:
+					counts.Write(checkpoint)
+
+	_BATCH_CONFIG.clear()
+	_BATCH_CONFIG.update( counts.GetConfig() )
+
+	try:
+		_BuildFields(_BATCH_CATALOGS,_BATCH_CONFIG)
+		if ncpu < 2 or len(jobs) == 1:
+			for job_ in jobs:
+				collect( _CountPairsChunk(job_) )
+		else:
+			_BATCH_CONFIG['num_threads'] = 1
+			pool = multiprocessing.Pool(processes=min(ncpu,len(jobs)))
+			try:
+				for result_ in pool.imap_unordered(_CountPairsChunk,jobs,chunksize=1):
+					collect( result_ )
+			finally:
+				pool.close()
+				pool.join()
+	finally:
+		del _BATCH_CATALOGS[:]
+		_BATCH_CONFIG.clear()
+
+	return counts
+
+def _GetDensityMap(sample,mask,isnest,nside,mask_ud):
+	ra,dec = sample[0],sample[1]
+	w      = sample[2] if len(sample) == 3 else numpy.ones(len(ra))
+	w      = numpy.asarray(w,dtype=numpy.float64)
+
+	nside_mask = healpy.npix2nside(len(mask))
+	inside = numpy.asarray(mask)[catutils.GetPixelIndex(ra,dec,nside_mask,nest=isnest)] > 0
+
+	pix    = catutils.GetPixelIndex(numpy.asarray(ra)[inside],numpy.asarray(dec)[inside],nside,nest=False)
+	counts = numpy.bincount(pix,weights=w[inside],minlength=healpy.nside2npix(nside))
+
+	nbar  = numpy.sum(counts)/numpy.sum(mask_ud)
+	delta = numpy.zeros(len(counts))
+	good  = mask_ud > 0
+	delta[good] = counts[good]/(nbar*mask_ud[good]) - 1.
+
+	noise = 4.*numpy.pi*numpy.sum(w[inside]**2)/(len(counts)**2*nbar**2)
+
+	return mask_ud*delta,noise
+
+def _Legendre(lmax,x):
+	pl = numpy.zeros([lmax+1,len(x)])
+	pl[0] = 1.
+	if lmax > 0:
+		pl[1] = x
+	for l_ in range(2,lmax+1):
+		pl[l_] = ((2.*l_-1.)*x*pl[l_-1] - (l_-1.)*pl[l_-2])/l_
+	return pl
+
+def Get2pacfMap(data_lens=[],data_sour=None,mask=None,nest=False,nside=1024,theta=None,lmax=None):
+	"""
+	Computes the 2pacf density-density cross/auto-correlation from HEALPix maps instead of pair counting, so the cost is set by nside rather than N**2.
+	The lens and source overdensity maps are built on the mask, their pseudo-C(l) are computed with spherical harmonic transforms
+	and transformed to w(theta), and the mode coupling induced by the mask is corrected by dividing by the correlation function of the mask.
+	Scales below two pixels (2*healpy.nside2resol(nside) ~ 2*58.6/nside deg) are not resolved, so they can not be requested.
+	-Input:
+		data_lens (list): a list containing [ra,dec,weight] for the lens, or a catutils.SharedCatalog. If weight is not provided, it will be assumed as 1.
+		data_sour (list): a list containing [ra,dec,weight] for the source, or a catutils.SharedCatalog. If weight is not provided, it will be assumed as 1.
+				  if None, the auto-correlation will be computed instead of the cross, with the shot noise subtracted.
+		mask (array or str): the HEALPix mask, e.g. from catutils.GetMasterMask, or the path to it. Pixels above 0 are in the footprint,
+				  whatever their value, so depth or seeing maps can be given as they are.
+		nest (bool): the ordering of mask if given as an array.
+		nside (int): the nside of the overdensity maps.
+		theta (array or DataW): the angles in degrees where w is computed, or a magnipy.DataW whose angles are used.
+				  If None, the centres of the bins used on Get2pacf that are resolved at nside.
+		lmax (int): the maximum multipole, at most 3*nside-1. If None, 3*nside-1.
+	-Output:
+		w (DataW): the 2pacf, with the Gaussian error of the pseudo-C(l) on the diagonal covariance.
+	"""
+
+	data_lens = _GetColumns(data_lens)
+	data_sour = _GetColumns(data_sour)
+
+	if mask is None:
+		raise ValueError('No mask given.')
+	if len(data_lens) not in [2,3]:
+		raise ValueError('Too many lens parameters.')
+	if not data_sour is None and len(data_sour) not in [2,3]:
+		raise ValueError('Too many source parameters.')
+
+	if isinstance(mask,str):
+		nside_mask,nest = catutils.GetMaskHeader(mask)
+		mask = healpy.read_map(mask,nest=nest)
+	mask = (numpy.asarray(mask) > 0).astype(numpy.float64)
+
+	resolution = 2.*healpy.nside2resol(nside,arcmin=True)/60.
+	if theta is None:
+		edges = numpy.logspace(math.log10(__MINSEP__),math.log10(__MAXSEP__),__NBINS__+1)
+		theta = numpy.sqrt(edges[1:]*edges[:-1])
+		theta = theta[theta >= resolution]
+		if len(theta) == 0:
+			raise ValueError('None of the default angles is resolved at nside '+str(nside)+'.')
+	elif isinstance(theta,magnipy.CorrelationFunction):
+		theta = theta.angle_
+	theta = numpy.asarray(theta,dtype=numpy.float64)
+	if numpy.any(theta < resolution):
+		raise ValueError('Angles below two pixels, '+str(resolution)+' deg, are not resolved at nside '+str(nside)+'.')
+
+	if lmax is None:
+		lmax = 3*nside-1
+	elif lmax > 3*nside-1:
+		raise ValueError('lmax can not be above 3*nside-1 = '+str(3*nside-1)+'.')
+
+	mask_ring = healpy.reorder(mask,n2r=True) if nest else mask
+	mask_ud   = healpy.ud_grade(mask_ring,nside,order_in='RING',order_out='RING')
+
+	map_lens,noise = _GetDensityMap(data_lens,mask,nest,nside,mask_ud)
+	alm_lens = healpy.map2alm(map_lens,lmax=lmax)
+	if data_sour is None:
+		alm_sour = alm_lens
+	else:
+		map_sour,_ = _GetDensityMap(data_sour,mask,nest,nside,mask_ud)
+		alm_sour = healpy.map2alm(map_sour,lmax=lmax)
+		del map_sour
+	del map_lens
+
+	cl_ls = healpy.alm2cl(alm_lens,alm_sour)
+	cl_ll = healpy.alm2cl(alm_lens)
+	cl_ss = healpy.alm2cl(alm_sour)
+	cl_mm = healpy.anafast(mask_ud,lmax=lmax)
+
+	cl_noisy = cl_ls
+	if data_sour is None:
+		cl_ls = cl_ls - noise
+
+	ell = numpy.arange(lmax+1)
+	pw2 = healpy.pixwin(nside)[:lmax+1]**2
+	pl  = _Legendre(lmax,numpy.cos(numpy.radians(theta)))
+	kl  = ((2.*ell+1.)/(4.*numpy.pi))[:,numpy.newaxis]*pl
+
+	w_pseudo = numpy.dot(cl_ls/pw2,kl)
+	w_mask   = numpy.dot(cl_mm,kl)
+	w        = w_pseudo/w_mask
+
+	w2   = numpy.mean(mask_ud**2)
+	fsky = w2**2/numpy.mean(mask_ud**4)
+	varc = ((cl_ll*cl_ss + cl_noisy**2)/w2**2)/((2.*ell+1.)*fsky)/pw2**2
+	varw = numpy.dot(varc,kl**2)
+
+	result = magnipy.DataW(name='map_nside'+str(nside))
+	result.angle_ = theta
+	result.w_     = w
+	result.error_ = numpy.sqrt(varw)
+	result.Nth_   = len(w)
+	result.SetDiagonalCovariance()
+
+	return result